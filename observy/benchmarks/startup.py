@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2016 Eldon Ahrold
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+''' Time a cron style one-shot observy run when nothing is due.
+
+    Compares three invocations against the same fake registry:
+      bare      - `python -c pass`, the floor we can't get under
+      baseline  - observy.py from before the one-shot path, pulled out of
+                  git into a temp dir. It parses the registry and probes
+                  every service on every run.
+      idle      - the current observy.py with every service not yet due
+
+    The fake services are named observy-bench-N and registered with an
+    empty success string, so the baseline's `service ... status` probes
+    all count as running and nothing gets restarted or notified.
+
+    Needs root and a git checkout, same as observy.py itself.
+'''
+
+import os, sys, getopt, subprocess
+import json
+import shutil
+import tempfile
+
+from time import time
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+OBSERVY = os.path.join(BASE_PATH, 'observy.py')
+
+# Files the baseline observy.py needs to run
+BASELINE_FILES = ('observy.py', 'notifications/__init__.py')
+
+def make_service_dir(count):
+    ''' Fake registry with `count` services none of which are due '''
+    path = tempfile.mkdtemp(prefix='observy-bench-')
+    due = time() + 3600
+    lines = []
+    for i in range(count):
+        service = 'observy-bench-%d' % i
+        service_dict = {
+            'service': service,
+            'success_string': '',
+            'attempt_restart': False,
+            'check_interval': 60,
+        }
+        with open(os.path.join(path, service + '.service'), 'w') as file:
+            file.write(json.dumps(service_dict, indent=2))
+        lines.append('%f %s\n' % (due, service))
+
+    # Due file goes last so it's newer than the directory
+    with open(os.path.join(path, '.observy.due'), 'w') as file:
+        file.writelines(lines)
+    return path
+
+def default_baseline():
+    ''' Parent of the commit that added this benchmark '''
+    path = os.path.splitext(os.path.realpath(__file__))[0] + '.py'
+    added = subprocess.check_output(
+        ['git', 'log', '--diff-filter=A', '--format=%H', '--', path],
+        cwd=BASE_PATH
+    ).split()
+    if not added:
+        raise Exception('%s is not committed, pass --baseline' % path)
+    return added[-1] + '^'
+
+def make_baseline_dir(rev):
+    ''' Copy of observy.py as of `rev`, returns the script path '''
+    path = tempfile.mkdtemp(prefix='observy-baseline-')
+    for name in BASELINE_FILES:
+        data = subprocess.check_output(['git', 'show', '%s:./%s' % (rev, name)],
+                                       cwd=BASE_PATH)
+        dst = os.path.join(path, name)
+        if not os.path.exists(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        with open(dst, 'w') as file:
+            file.write(data)
+    return os.path.join(path, 'observy.py')
+
+def timed(cmd, runs):
+    ''' Average wall time in ms of running `cmd` `runs` times '''
+    devnull = open(os.devnull, 'w')
+    total = 0.0
+    for i in range(runs):
+        start = time()
+        rc = subprocess.call(cmd, cwd=BASE_PATH, stdout=devnull, stderr=devnull)
+        total += time() - start
+        if rc != 0:
+            raise Exception('%s exited with %d' % (' '.join(cmd), rc))
+    devnull.close()
+    return (total / runs) * 1000
+
+def usage(err=None, returncode=0):
+    if(err):
+        print str(err)
+    print '''Usage: %s OPTIONS
+Options:
+   -n, --runs=INT              Invocations to average over, defaults to 20
+   -s, --services=INT          Number of fake registered services, defaults to 10
+   -b, --baseline=REV          Git revision to compare against, defaults to the
+                               commit before this benchmark was added
+   -h, --help                  Show this help info
+''' % (os.path.basename(__file__))
+    sys.exit(returncode)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], "n:s:b:h",
+                                   ["runs=", "services=", "baseline=", "help"])
+    except getopt.GetoptError as err:
+        usage(err, 2)
+
+    runs = 20
+    count = 10
+    rev = None
+    for opt, arg in opts:
+        if opt in ("-n", "--runs"):
+            runs = int(arg)
+        if opt in ("-s", "--services"):
+            count = int(arg)
+        if opt in ("-b", "--baseline"):
+            rev = arg
+        if opt in ("-h", "--help"):
+            usage()
+
+    if os.geteuid() != 0:
+        exit("observy.py needs root privileges, so does this benchmark. Exiting.")
+
+    rev = rev or default_baseline()
+    baseline_observy = make_baseline_dir(rev)
+    service_dir = make_service_dir(count)
+    try:
+        python = sys.executable
+        directory = '--directory=%s' % service_dir
+        bare = timed([python, '-c', 'pass'], runs)
+        baseline = timed([python, baseline_observy, directory], runs)
+        idle = timed([python, OBSERVY, directory], runs)
+    finally:
+        shutil.rmtree(service_dir)
+        shutil.rmtree(os.path.dirname(baseline_observy))
+
+    print 'runs: %d, services: %d, baseline: %s' % (runs, count, rev)
+    print 'bare      %8.2f ms' % bare
+    print 'baseline  %8.2f ms  (+%.2f ms over bare)' % (baseline, baseline - bare)
+    print 'idle      %8.2f ms  (+%.2f ms over bare)' % (idle, idle - bare)
+    print 'gain      %8.2f ms per invocation' % (baseline - idle)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
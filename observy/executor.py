@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+
+# MIT License
+
+# Copyright (c) 2016 Eldon Ahrold
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+''' Probe executor for the observy daemon.
+
+    The daemon keeps one of these running as a separate, small process and
+    hands it the `service` commands to run over a pipe. Forking happens from
+    the helper's address space instead of the daemon's, and a hung or greedy
+    init script can only tie up the helper.
+
+    Requests and responses are one JSON object per line.
+'''
+
+import os, sys
+import json
+import signal
+
+from time import time
+
+# Defaults for every request, the daemon can override them per request
+TIMEOUT = 30            # seconds of wall time
+CPU_LIMIT = 10          # seconds of cpu time
+MEMORY_LIMIT = 256      # megabytes of resident memory
+OUTPUT_LIMIT = 65536    # bytes kept from each of stdout / stderr
+
+# Return code for commands we killed, same as timeout(1)
+KILLED_RC = 124
+
+# Extra seconds the daemon waits on the helper past the request's timeout
+RESPONSE_MARGIN = 5
+
+
+class ProbeError(Exception):
+    '''The helper couldn't get a trustworthy answer out of the command,
+       it failed to spawn, timed out or hit a resource limit.
+    '''
+    pass
+
+
+#----------------------------------------------------------
+# Daemon side
+#-------------------------------------------------------
+class ProbeExecutor(object):
+    '''Client for the helper process'''
+
+    _proc = None
+
+    def __init__(self, timeout=TIMEOUT, cpu_limit=CPU_LIMIT,
+                 memory_limit=MEMORY_LIMIT, output_limit=OUTPUT_LIMIT):
+        super(ProbeExecutor, self).__init__()
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.output_limit = output_limit
+
+    def execute(self, args, sandbox=True):
+        ''' Run `args` in the helper, returns (stdout, stderr, returncode).
+            With sandbox the command gets its own session and the
+            cpu / memory limits, leave it off for commands that start
+            long lived processes so they don't inherit the limits.
+            Sandboxed commands are probes whose output gets compared,
+            so for those truncated stdout is an error too.
+            Raises ProbeError when the helper couldn't run the command,
+            OSError when the request never reached the helper.
+        '''
+        request = {
+            'args': args,
+            'sandbox': sandbox,
+            'timeout': self.timeout,
+            'cpu_limit': self.cpu_limit,
+            'memory_limit': self.memory_limit,
+            'output_limit': self.output_limit,
+        }
+        line = json.dumps(request) + '\n'
+
+        # One retry, the helper may have died since the last request. Only
+        # while sending, once it has the request a retry could run a
+        # `service start` twice.
+        for attempt in range(2):
+            try:
+                proc = self._helper()
+                proc.stdin.write(line)
+                proc.stdin.flush()
+                break
+            except (OSError, IOError):
+                self.close()
+        else:
+            raise OSError('probe executor is not responding')
+
+        try:
+            response = json.loads(self._read_response(proc))
+        except (OSError, IOError, ValueError) as e:
+            self._kill()
+            raise ProbeError('probe executor failed: %s' % e)
+
+        if response.get('error'):
+            raise ProbeError(response['error'])
+        if sandbox and response.get('truncated'):
+            raise ProbeError('output was over %d bytes' % self.output_limit)
+        return self._decode(response)
+
+    def _read_response(self, proc):
+        ''' One line from the helper, bounded by the request timeout so a
+            wedged helper can't hang the daemon
+        '''
+        import errno
+        import select
+        fd = proc.stdout.fileno()
+        deadline = time() + self.timeout + RESPONSE_MARGIN
+        data = ''
+        while not data.endswith('\n'):
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise OSError('no response after %s seconds' % (self.timeout + RESPONSE_MARGIN))
+            try:
+                if not select.select([fd], [], [], remaining)[0]:
+                    continue
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise OSError('helper exited')
+            data += chunk
+        return data
+
+    def close(self):
+        proc, self._proc = self._proc, None
+        if not proc:
+            return
+        try:
+            proc.stdin.close()
+            proc.wait()
+        except (OSError, IOError):
+            pass
+
+    def _kill(self):
+        if self._proc:
+            try:
+                self._proc.kill()
+            except OSError:
+                pass
+        self.close()
+
+    def _helper(self):
+        import subprocess
+        if self._proc and self._proc.poll() is None:
+            return self._proc
+
+        path = os.path.splitext(os.path.realpath(__file__))[0] + '.py'
+        self._proc = subprocess.Popen(
+            [sys.executable, path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            close_fds=True,
+            # Own process group, ctrl-c on the daemon shouldn't reach it,
+            # it exits when the daemon closes the pipe.
+            preexec_fn=os.setpgrp
+        )
+        return self._proc
+
+    @staticmethod
+    def _decode(response):
+        # latin-1 round trips arbitrary bytes through json
+        return (response['out'].encode('latin-1'),
+                response['err'].encode('latin-1'),
+                response['rc'])
+
+
+#----------------------------------------------------------
+# Helper side
+#-------------------------------------------------------
+def _preexec(request):
+    ''' preexec_fn for every command '''
+    sandbox = request.get('sandbox', True)
+
+    def preexec():
+        # Python ignores SIGPIPE and ignored signals survive exec, hand the
+        # command (and any service it starts) the defaults.
+        for sig in (signal.SIGPIPE, signal.SIGXFSZ, signal.SIGINT):
+            signal.signal(sig, signal.SIG_DFL)
+        if not sandbox:
+            return
+
+        # Own session so the limits can find, and kill, the whole tree
+        os.setsid()
+    return preexec
+
+def _usage(pgid):
+    ''' (cpu seconds, resident MB) summed over the process group.
+        Limits are polled rather than set with setrlimit, an rlimit only
+        shows up as some nested process failing and we couldn't tell that
+        apart from the service being down.
+    '''
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    page_mb = os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+    cpu = 0.0
+    rss = 0.0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid, 'r') as file:
+                # Fields after the parenthesised command name
+                stat = file.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        if int(stat[2]) != pgid:
+            continue
+        # utime, stime and the reaped children's cutime, cstime
+        cpu += sum(int(t) for t in stat[11:15]) / ticks
+        rss += int(stat[21]) * page_mb
+    return (cpu, rss)
+
+def _kill(proc, group):
+    try:
+        if group:
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except OSError:
+        pass
+
+def run_command(request):
+    ''' Run a single request, returns (stdout, stderr, returncode,
+        truncated, error) where truncated says stdout was cut off at
+        the output limit and error is None unless the result can't be
+        trusted.
+    '''
+    import errno
+    import select
+    import subprocess
+
+    sandbox = request.get('sandbox', True)
+    timeout = request.get('timeout', TIMEOUT)
+    cpu_limit = request.get('cpu_limit', CPU_LIMIT)
+    memory_limit = request.get('memory_limit', MEMORY_LIMIT)
+    output_limit = request.get('output_limit', OUTPUT_LIMIT)
+
+    # Not our stdin, that's the daemon's request pipe
+    devnull = open(os.devnull, 'r')
+    try:
+        proc = subprocess.Popen(
+            request['args'],
+            stdin=devnull,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True,
+            preexec_fn=_preexec(request)
+        )
+    except Exception as e:
+        # Includes errors raised by the preexec_fn
+        return ('', str(e), 127, False, 'could not spawn %s: %s' % (' '.join(request['args']), e))
+    finally:
+        devnull.close()
+
+    output = { proc.stdout: [], proc.stderr: [] }
+    kept = { proc.stdout: 0, proc.stderr: 0 }
+    truncated = False
+    deadline = time() + timeout
+    error = None
+
+    pipes = [proc.stdout, proc.stderr]
+    while pipes:
+        remaining = deadline - time()
+        if remaining <= 0:
+            error = 'timed out after %s seconds' % timeout
+            _kill(proc, sandbox)
+            break
+
+        if sandbox and proc.poll() is None:
+            cpu, rss = _usage(proc.pid)
+            if cpu > cpu_limit:
+                error = 'used over %s seconds of cpu' % cpu_limit
+            elif rss > memory_limit:
+                error = 'used over %sMB of memory' % memory_limit
+            if error:
+                _kill(proc, sandbox)
+                break
+
+        # Short waits so we notice the command exiting while something
+        # it started in the background still holds the pipes open.
+        exited = proc.poll() is not None
+        try:
+            ready = select.select(pipes, [], [], 0 if exited else min(remaining, 0.1))[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for pipe in ready:
+            chunk = os.read(pipe.fileno(), 4096)
+            if not chunk:
+                pipes.remove(pipe)
+                continue
+            # Keep reading past the limit so the command never blocks on a
+            # full pipe, just stop storing it.
+            room = output_limit - kept[pipe]
+            if room > 0:
+                output[pipe].append(chunk[:room])
+                kept[pipe] += min(room, len(chunk))
+            if len(chunk) > room and pipe is proc.stdout:
+                truncated = True
+
+        if exited and not ready:
+            break
+
+    proc.stdout.close()
+    proc.stderr.close()
+    rc = proc.wait()
+
+    out = ''.join(output[proc.stdout])
+    err = ''.join(output[proc.stderr])
+    if error:
+        err += '\n' + error
+        rc = KILLED_RC
+    return (out, err, rc, truncated, error)
+
+def serve(infile=sys.stdin, outfile=sys.stdout):
+    ''' Answer requests until the daemon closes our stdin '''
+    while True:
+        line = infile.readline()
+        if not line:
+            break
+        try:
+            out, err, rc, truncated, error = run_command(json.loads(line))
+        except Exception as e:
+            error = 'probe executor error: %s' % e
+            out, err, rc, truncated = '', error, 1, False
+
+        response = {
+            'out': out.decode('latin-1'),
+            'err': err.decode('latin-1'),
+            'rc': rc,
+            'truncated': truncated,
+            'error': error,
+        }
+        outfile.write(json.dumps(response) + '\n')
+        outfile.flush()
+
+if __name__ == "__main__":
+    sys.exit(serve())
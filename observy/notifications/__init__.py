@@ -18,10 +18,8 @@ import os
 import json
 import glob
 import importlib
-import socket
 
 from datetime import datetime as date
-from notifications import *
 
 __version__ = '0.1'
 
@@ -99,6 +97,7 @@ class Notifications(object):
         raise('Subclass must implement')
 
     def host_info(self):
+        import socket
         hostname = socket.gethostname()
         return {
             "host": hostname,
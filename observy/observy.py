@@ -22,14 +22,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import os, sys, getopt, subprocess
-import json
+import os, sys, getopt
 import syslog
 
-from datetime import datetime, timedelta
-from time import sleep
+from time import sleep, time
 
-from notifications import NotificationManager
+# Heavier modules (subprocess, json, datetime, notifications) are imported
+# where they are used so a cron run with nothing due stays cheap.
 
 
 __version__ = '0.1'
@@ -41,7 +40,12 @@ class ServiceMonitor(object):
     '''Base class for service monitor'''
 
     error_bag = None
-    _last_checks = None
+    executor = None
+    _next_due = None
+
+    # Seconds early a service may be checked. run_once() sets it since cron
+    # starts us on the minute but the last probe landed a bit after that.
+    due_slack = 0
 
     _localizables = {
         'err.reg': "There was a problem registering the service (%s)",
@@ -58,17 +62,25 @@ class ServiceMonitor(object):
         self.error_bag = []
         self._service_dir = service_dir if service_dir \
                                         else self.service_dir()
-        self._last_checks = {}
+        self._next_due = {}
 
     #----------------------------------------------------------
     # Check The services
     #-------------------------------------------------------
     def check(self):
         '''Check services'''
+        from datetime import datetime
+        from executor import ProbeError
+
         self.error_bag = []
         services = self.get_registered_services()
         success = True
 
+        # Forget due times of services that are no longer registered
+        names = [s['service'] for s in services]
+        self._next_due = dict((s, d) for s, d in self._next_due.items()
+                                        if s in names)
+
         for service_dict in services:
             service = service_dict['service']
             success_string = service_dict['success_string']
@@ -77,19 +89,29 @@ class ServiceMonitor(object):
 
             if self._should_check(service, check_interval):
                 print "Checking %s" % service
-                out, err, rc = self._status(service);
+                try:
+                    out, err, rc = self._status(service);
+                    internal_rc = 0 if out == success_string or out.startswith(success_string) else 1
+                except ProbeError as e:
+                    # Our problem, not the service's. Report it, don't restart
+                    internal_rc = 4
+                    attempt_restart = False
+                    out = str(e)
 
-                internal_rc = 0 if out == success_string or out.startswith(success_string) else 1
                 if internal_rc is not 0:
                     success = False
                     if attempt_restart:
-                        if self._start(service) != 0:
-                            internal_rc = 2        
-                        else:
-                            internal_rc = 3
+                        try:
+                            restarted = self._start(service) == 0
+                        except ProbeError:
+                            restarted = False
+                        internal_rc = 3 if restarted else 2
                     
+                    message = self._status_message(service, internal_rc)
+                    if internal_rc == 4:
+                        message = '%s (%s)' % (message, out)
                     error = { 'status_code': internal_rc,
-                              'message': self._status_message(service, internal_rc),
+                              'message': message,
                               'date': str(datetime.now()),
                             }
                     self.error_bag.append(error)
@@ -99,6 +121,7 @@ class ServiceMonitor(object):
     # Get/Set registered services
     #-------------------------------------------------------
     def register_service(self, service, interval=60, attempt_restart=True, force=False):
+        import json
         global __version__
 
         for s in self._service_list(force)[0]:
@@ -124,6 +147,7 @@ class ServiceMonitor(object):
                 os.makedirs(self._service_dir)
 
             path = os.path.join(self._service_dir, service_file)
+            self._clear_due_times()
             with open(path, 'wb') as file:
                 data = json.dumps(service_dict, indent=2)
                 file.write(data)
@@ -140,6 +164,7 @@ class ServiceMonitor(object):
             try: 
                 print self._localizables['rem.serv'] % service 
                 os.remove(path)
+                self._clear_due_times()
             except Exception as e:
                 print self._localizables['err.rem.serv'] 
                 return 1
@@ -150,6 +175,7 @@ class ServiceMonitor(object):
 
     def get_registered_services(self):
         import glob
+        import json
         services = []
         service_files = glob.glob(self._service_dir+'/*.service')
         for item in service_files:
@@ -157,20 +183,66 @@ class ServiceMonitor(object):
             services.append(json.loads(data))
         return services
 
+    #----------------------------------------------------------
+    # Persisted due times
+    #-------------------------------------------------------
+    def load_due_times(self):
+        '''Load the due times saved by the last run.
+           Returns True if any service is due (or if we can't tell)
+        '''
+        path = self._due_file()
+        try:
+            # A service file was added or removed since the last run
+            changed = os.stat(self._service_dir).st_mtime >= \
+                            os.stat(path).st_mtime
+
+            next_due = {}
+            with open(path, 'r') as file:
+                for line in file:
+                    due, service = line.split(None, 1)
+                    next_due[service.strip()] = float(due)
+        except (OSError, IOError, ValueError):
+            return True
+
+        self._next_due = next_due
+        now = time() + self.due_slack
+        return changed or any(due <= now for due in next_due.values())
+
+    def save_due_times(self):
+        '''Persist the due times so the next run can exit early'''
+        # Written in place, a rename would bump the directory mtime
+        # and make every following run look stale.
+        lines = ['%f %s\n' % (due, service)
+                    for service, due in self._next_due.items()]
+        try:
+            with open(self._due_file(), 'w') as file:
+                file.writelines(lines)
+        except (OSError, IOError):
+            pass
+
+    def _clear_due_times(self):
+        self._next_due = {}
+        try:
+            os.remove(self._due_file())
+        except OSError:
+            pass
+
+    def _due_file(self):
+        return os.path.join(self._service_dir, '.observy.due')
+
     #----------------------------------------------------------
     # Util
     #-------------------------------------------------------
     def _should_check(self, service, interval):
         # Do the date compare routine 
-        now = datetime.now()
-        last_check = self._last_checks.get(service);
+        now = time()
+        next_due = self._next_due.get(service);
         
-        should =  not last_check or \
-            ((now - last_check) > timedelta(minutes=interval))
+        should = not next_due or now + self.due_slack >= next_due
 
         if should:
-            # if we should check update the timestamp to now
-            self._last_checks[service] = now;
+            # if we should check push the due time out by the interval
+            self._next_due[service] = now + (interval * 60);
         return should
 
 
@@ -185,6 +257,8 @@ class ServiceMonitor(object):
             message = 'was offline, and restart failed'
         elif rc == 3:
             message = 'was offline, but was successfully restarted'
+        elif rc == 4:
+            message = 'could not be checked'
         
         return '%s %s' % (service, message)
 
@@ -193,10 +267,11 @@ class ServiceMonitor(object):
     # Subprocess
     #------------------------------------------------------
     def _start(self, service):
-        return self._exec_service(service, 'start')[2]
+        # Not sandboxed, the limits would carry over to the started service
+        return self._exec_service(service, 'start', sandbox=False)[2]
 
     def _stop(self, service):
-        return self._exec_service(service, 'stop')[2]
+        return self._exec_service(service, 'stop', sandbox=False)[2]
 
     def _status(self, service):
         return self._exec_service(service, 'status')
@@ -216,6 +291,7 @@ class ServiceMonitor(object):
         return (running, stopped)
 
     def _status_all(self):
+        import subprocess
         proc = subprocess.Popen(
             ["/usr/sbin/service", '--status-all'],
             stdout=subprocess.PIPE, 
@@ -224,9 +300,17 @@ class ServiceMonitor(object):
         (data, error) = proc.communicate()
         return (data.splitlines(), error.splitlines())
 
-    def _exec_service(self, service, cmd):
+    def _exec_service(self, service, cmd, sandbox=True):
+        args = ["/usr/sbin/service", service, cmd]
+        if self.executor:
+            try:
+                return self.executor.execute(args, sandbox)
+            except OSError as e:
+                syslog.syslog(syslog.LOG_ERR, "Probe executor failed %s" % e)
+
+        import subprocess
         proc = subprocess.Popen(
-            ["/usr/sbin/service", service, cmd], 
+            args, 
             stdout=subprocess.PIPE, 
             stderr=subprocess.PIPE
         )
@@ -239,13 +323,38 @@ class ServiceMonitor(object):
 
 def run(service_checker, keep_alive=False):
     ''' Execute the service checker process '''
-    i = 0
-    while True:
-        if not service_checker.check():
-            notifier = NotificationManager(service_checker.error_bag);
-            notifier.send()
-        if not keep_alive: break
-        sleep(1)
+    if not keep_alive:
+        return run_once(service_checker)
+
+    # Probes are spawned from a small helper process rather than the daemon
+    from executor import ProbeExecutor
+    service_checker.executor = ProbeExecutor()
+    try:
+        while True:
+            if not service_checker.check():
+                notify(service_checker.error_bag)
+            sleep(1)
+    finally:
+        service_checker.executor.close()
+
+def run_once(service_checker):
+    ''' Single pass for cron, bails out before reading the
+        registry when the persisted due times say nothing is due
+    '''
+    service_checker.due_slack = 30
+    if not service_checker.load_due_times():
+        return 0
+
+    success = service_checker.check()
+    service_checker.save_due_times()
+    if not success:
+        notify(service_checker.error_bag)
+    return 0
+
+def notify(errors):
+    from notifications import NotificationManager
+    notifier = NotificationManager(errors);
+    notifier.send()
 
 #----------------------------------------------------------
 # Install / Uninstall
@@ -256,6 +365,7 @@ def initd_script_name():
 def install(service_data_dir):
     ''' Install the rc.d script, register with update-rc.d
     '''
+    import subprocess
     from shutil import copyfile
     base_path = os.path.dirname(os.path.realpath(__file__))
     
@@ -302,6 +412,7 @@ def install(service_data_dir):
 
 def remove():
     ''' Remove from update-rc.d'''
+    import subprocess
     print "Removing the init.d script and stopping service"
     stdout = subprocess.PIPE
 
@@ -453,6 +564,7 @@ def main(argv):
 
     # Register Webhooks
     if webhook:
+        from notifications import NotificationManager
         hook = webhook.split(':', 1)
         if not remove_webhook:
             NotificationManager.register_webhook(hook[0], hook[1])